@@ -4,16 +4,27 @@ import cv2
 import numpy as np
 from datetime import datetime
 import json
+import atexit
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 from flask import Flask, request, abort
 import telebot
 
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ReadTimeout
 
 from pyzbar.pyzbar import decode, ZBarSymbol
-import pytesseract
-from thefuzz import process
+try:
+    import zxingcpp
+except ImportError:  # no wheel for this platform: zbar does the decoding
+    zxingcpp = None
+from rapidfuzz import process, fuzz, utils
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 ########################################
@@ -27,7 +38,9 @@ ASSET_TAB_NAME = "Asset Data"
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN not set")
 
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, parse_mode="HTML")
+# threaded: process_new_updates only queues handlers on the bot's worker
+# pool, so the webhook request is acknowledged without waiting on them
+bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, parse_mode="HTML", threaded=True, num_threads=4)
 app = Flask(__name__)
 
 ########################################
@@ -38,16 +51,50 @@ scope = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/spreadsheets"
 ]
-credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+credentials = Credentials.from_service_account_info(creds_dict, scopes=scope)
 gc = gspread.authorize(credentials)
-main_sheet = gc.open_by_key(SPREADSHEET_ID).sheet1
+# keep-alive pool sized for the decode/flush threads writing concurrently;
+# gspread 6 keeps its requests.Session on http_client, 5.x on the client
+gs_session = getattr(gc, "http_client", gc).session
+gs_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+# a hung Sheets call must not pin a flush/decode worker indefinitely, but
+# a large append can legitimately take 20 s: fail fast only on connect
+gc.set_timeout((5, 60))
+spreadsheet = gc.open_by_key(SPREADSHEET_ID)
+main_sheet = spreadsheet.sheet1
 print("Google Sheets qoşuldu:", main_sheet.title)
 
+# the asset list changes rarely; a local copy saves the Sheets read on
+# every restart/redeploy as long as it is fresh
+# keyed by spreadsheet so another sheet (or bot on the same host) never
+# reads this one's list
+ASSET_CACHE_PATH = os.getenv("ASSET_CACHE_PATH", f"/tmp/asset_data_{SPREADSHEET_ID}.json")
+ASSET_CACHE_TTL = 3600  # seconds
+
+def load_assets():
+    try:
+        if time.time()-os.path.getmtime(ASSET_CACHE_PATH) < ASSET_CACHE_TTL:
+            with open(ASSET_CACHE_PATH, encoding="utf-8") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass  # missing or unreadable cache: fall through to Sheets
+
+    asset_worksheet = spreadsheet.worksheet(ASSET_TAB_NAME)
+    data = asset_worksheet.col_values(1)
+    if data and data[0].lower().startswith("asset"):
+        data.pop(0)
+    try:
+        # write-then-rename so a concurrent reader never sees half a file
+        tmp = f"{ASSET_CACHE_PATH}.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, ASSET_CACHE_PATH)
+    except OSError as e:
+        print("Aktiv keşi yazılarkən xəta:", e)
+    return data
+
 try:
-    asset_worksheet = gc.open_by_key(SPREADSHEET_ID).worksheet(ASSET_TAB_NAME)
-    asset_data = asset_worksheet.col_values(1)
-    if asset_data and asset_data[0].lower().startswith("asset"):
-        asset_data.pop(0)
+    asset_data = load_assets()
 except Exception as e:
     print("Aktiv məlumatı yüklənərkən xəta:", e)
     asset_data = []
@@ -55,11 +102,125 @@ except Exception as e:
 print(f"'{ASSET_TAB_NAME}' səhifəsində {len(asset_data)} sətir.")
 
 ########################################
-# Session
+# Sheet write buffer
 ########################################
-user_data = {}
-user_state = {}
+# Confirmed rows are queued per chat and written with one append_rows call
+# on /finish or by the periodic flush, instead of one request per entry.
+FLUSH_INTERVAL = 10  # seconds
+
+pending_rows = defaultdict(list)
+pending_lock = threading.Lock()
+flush_failing = set()  # chats already told their rows are stuck
+
+def queue_row(chat_id, row):
+    with pending_lock:
+        pending_rows[chat_id].append(row)
+
+class RowsDropped(Exception):
+    """A batch that was not re-queued: it may already be in the sheet, or
+    Sheets rejected it for good. Its rows are in the log."""
+
+def log_rows(label, rows):
+    print(label, json.dumps(rows, ensure_ascii=False))
+
+def flush_rows(chat_id):
+    with pending_lock:
+        rows = pending_rows.pop(chat_id, [])
+    if not rows:
+        return 0
+    try:
+        main_sheet.append_rows(rows, value_input_option="RAW",
+                               insert_data_option="INSERT_ROWS", table_range="A1")
+    except ReadTimeout as e:
+        # the request was sent: Google may finish the append after we gave
+        # up, and sending it again would write every row twice
+        log_rows("Cədvəl cavab vermədi, sətirlər yazılmış ola bilər:", rows)
+        raise RowsDropped(f"cədvəl cavab vermədi ({e})") from e
+    except gspread.exceptions.APIError as e:
+        status = e.response.status_code
+        if 400 <= status < 500 and status not in (408, 429):
+            # a rejected request fails the same way on every retry
+            log_rows("Cədvəl sətirləri qəbul etmədi:", rows)
+            raise RowsDropped(str(e)) from e
+        requeue_rows(chat_id, rows)
+        raise
+    except Exception:
+        requeue_rows(chat_id, rows)
+        raise
+    return len(rows)
+
+def requeue_rows(chat_id, rows):
+    # put them back in front so the next flush retries in order
+    with pending_lock:
+        pending_rows[chat_id][:0] = rows
+
+def notify(chat_id, text):
+    try:
+        bot.send_message(chat_id, text)
+    except Exception as e:
+        # never let a Telegram error stop the flush timer
+        print("Bildiriş göndərilərkən xəta:", e)
+
+def flush_rows_logged(chat_id):
+    # retryable failures keep the rows for the next flush; the chat hears
+    # once when they get stuck and once when they finally reach the sheet
+    try:
+        flush_rows(chat_id)
+        error = None
+    except RowsDropped as e:
+        print("Cədvələ yazılarkən xəta:", e)
+        notify(chat_id,
+            f"❌ Son məlumatlar cədvələ yazılmamış ola bilər, cədvəli yoxlayın: {e}")
+        return
+    except Exception as e:
+        print("Cədvələ yazılarkən xəta:", e)
+        error = e
+    with pending_lock:
+        was_failing = chat_id in flush_failing
+        if error is None:
+            flush_failing.discard(chat_id)
+        else:
+            flush_failing.add(chat_id)
+    if error is not None and not was_failing:
+        notify(chat_id,
+            f"❌ Məlumatlar cədvələ yazıla bilmədi, yenidən cəhd ediləcək: {error}")
+    elif error is None and was_failing:
+        notify(chat_id, "✅ Gözləyən məlumatlar cədvələ yazıldı.")
+
+def flush_all_rows():
+    with pending_lock:
+        chat_ids = list(pending_rows)
+    for chat_id in chat_ids:
+        flush_rows_logged(chat_id)
+
+def start_flush_timer():
+    def tick():
+        flush_all_rows()
+        start_flush_timer()
+    t = threading.Timer(FLUSH_INTERVAL, tick)
+    t.daemon = True
+    t.start()
+
+def flush_on_exit():
+    # SIGTERM on every deploy/restart: the daemon timer dies with the
+    # process, so write whatever is still buffered before exiting
+    with pending_lock:
+        chat_ids = list(pending_rows)
+    for chat_id in chat_ids:
+        try:
+            flush_rows(chat_id)
+        except RowsDropped as e:
+            print("Cədvələ yazılarkən xəta:", e)  # rows already logged
+        except Exception as e:
+            print("Cədvələ yazılarkən xəta:", e)
+            # last resort: keep the rows in the log so they can be re-entered
+            with pending_lock:
+                rows = pending_rows.get(chat_id, [])
+            log_rows("Yazılmamış sətirlər:", rows)
 
+########################################
+# Session
+########################################
 STATE_IDLE = "idle"
 STATE_WAIT_LOCATION = "wait_location"
 STATE_WAIT_INVENTORY_CHOICE = "wait_inventory_choice"
@@ -70,27 +231,71 @@ STATE_WAIT_ASSET_PICK = "wait_asset_pick"
 STATE_WAIT_QUANTITY = "wait_quantity"
 STATE_WAIT_CONFIRM = "wait_confirm"
 
+@dataclass(slots=True)
+class Session:
+    state: str = STATE_IDLE
+    location: str = ""
+    inventory_code: str = ""
+    mode: str = "single"   # single or multi
+    barcodes: list = field(default_factory=list)
+    index: int = 0
+    asset_name: str = ""
+    qty: int = 0
+    pending_barcode: str | None = None
+    pending_asset: str | None = None
+    pending_qty: int | None = None
+    # barcodes confirmed this session; asset tags are unique, so a repeat
+    # is a re-scan, not a second item
+    recorded: set = field(default_factory=set)
+    # handlers and the decode workers both touch a session
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    touched: float = field(default_factory=time.monotonic, repr=False, compare=False)
+
+# LRU-bounded so a long-running worker doesn't keep every chat it has seen;
+# sessions idle for longer than a working day expire and start over
+MAX_SESSIONS = 10000
+SESSION_TTL = 12 * 3600  # seconds
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+
+def _expired(s, now):
+    return now - s.touched > SESSION_TTL
+
+def _store_session(chat_id, s):
+    # caller holds sessions_lock
+    now = time.monotonic()
+    s.touched = now
+    sessions[chat_id] = s
+    sessions.move_to_end(chat_id)
+    # least recently used first: drop expired entries, then any overflow
+    while len(sessions) > MAX_SESSIONS or _expired(next(iter(sessions.values())), now):
+        sessions.popitem(last=False)
+
+def get_session(chat_id):
+    with sessions_lock:
+        s = sessions.get(chat_id)
+        if s is None or _expired(s, time.monotonic()):
+            s = Session()
+        _store_session(chat_id, s)
+        return s
+
+def session_state(chat_id):
+    s = sessions.get(chat_id)
+    if s is None or _expired(s, time.monotonic()):
+        return STATE_IDLE
+    return s.state
+
 def init_session(chat_id):
-    user_data[chat_id] = {
-        "location": "",
-        "inventory_code": "",
-        "mode": "single",   # single or multi
-        "barcodes": [],
-        "index": 0,
-        "asset_name": "",
-        "qty": 0,
-        "pending_barcode": None,
-        "pending_asset": None,
-        "pending_qty": None
-    }
-    user_state[chat_id] = STATE_IDLE
+    with sessions_lock:
+        _store_session(chat_id, Session())
 
 ########################################
 # Webhook Setup
 ########################################
 def setup_webhook():
     bot.remove_webhook()
-    domain = os.getenv("RENDER_EXTERNAL_HOSTNAME") or "https://yourapp.onrender.com"
+    host = os.getenv("RENDER_EXTERNAL_HOSTNAME")
+    domain = f"https://{host}" if host else "https://yourapp.onrender.com"
     wh_url = f"{domain}/webhook/{TELEGRAM_BOT_TOKEN}"
     bot.set_webhook(url=wh_url)
     print("Webhook set to:", wh_url)
@@ -122,6 +327,8 @@ def cmd_finish(msg):
     init_session(chat_id)
     bot.send_message(chat_id,
         "Günü bitirdiniz! Sabah yenidən /start yaza bilərsiniz.")
+    # reply first, the sheet round-trip happens in the background
+    EXECUTOR.submit(flush_rows_logged, chat_id)
 
 @bot.message_handler(commands=['cancel'])
 def cmd_cancel(msg):
@@ -135,14 +342,14 @@ def cmd_cancel(msg):
 @bot.callback_query_handler(func=lambda c: c.data=="ENTER_LOCATION")
 def cb_enter_location(call):
     chat_id = call.message.chat.id
-    user_state[chat_id] = STATE_WAIT_LOCATION
+    get_session(chat_id).state = STATE_WAIT_LOCATION
     bot.send_message(chat_id, "Olduğunuz yeri daxil edin (örn: 'Anbar 3').")
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id)==STATE_WAIT_LOCATION, content_types=['text'])
+@bot.message_handler(func=lambda m: session_state(m.chat.id)==STATE_WAIT_LOCATION, content_types=['text'])
 def handle_location_input(m):
     chat_id = m.chat.id
     loc = m.text.strip()
-    user_data[chat_id]["location"] = loc
+    get_session(chat_id).location = loc
 
     kb = InlineKeyboardMarkup()
     kb.add(
@@ -158,17 +365,17 @@ def handle_location_input(m):
 def cb_inv_choice(call):
     chat_id = call.message.chat.id
     if call.data=="INVENTORY_ENTER":
-        user_state[chat_id] = STATE_WAIT_INVENTORY_INPUT
+        get_session(chat_id).state = STATE_WAIT_INVENTORY_INPUT
         bot.send_message(chat_id, "Zəhmət olmasa inventar kodunu daxil edin.")
     else:
-        user_data[chat_id]["inventory_code"] = ""
+        get_session(chat_id).inventory_code = ""
         show_mode_keyboard(chat_id)
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id)==STATE_WAIT_INVENTORY_INPUT, content_types=['text'])
+@bot.message_handler(func=lambda m: session_state(m.chat.id)==STATE_WAIT_INVENTORY_INPUT, content_types=['text'])
 def handle_inv_input(m):
     chat_id = m.chat.id
     inv = m.text.strip()
-    user_data[chat_id]["inventory_code"] = inv
+    get_session(chat_id).inventory_code = inv
     bot.send_message(chat_id, f"İnventar kodu qəbul edildi: {inv}")
     show_mode_keyboard(chat_id)
 
@@ -185,17 +392,17 @@ def show_mode_keyboard(chat_id):
         "Rejimi seçin (tək, ya çox barkod).",
         reply_markup=kb
     )
-    user_state[chat_id] = STATE_WAIT_PHOTO
+    get_session(chat_id).state = STATE_WAIT_PHOTO
 
 @bot.callback_query_handler(func=lambda c: c.data in ["MODE_SINGLE","MODE_MULTI"])
 def cb_pick_mode(call):
     chat_id = call.message.chat.id
-    d = user_data[chat_id]
+    d = get_session(chat_id)
     if call.data=="MODE_SINGLE":
-        d["mode"] = "single"
+        d.mode = "single"
         bot.send_message(chat_id, "Tək barkod rejimi. Barkod foto göndərin.")
     else:
-        d["mode"] = "multi"
+        d.mode = "multi"
         kb = InlineKeyboardMarkup()
         kb.row(
             InlineKeyboardButton("Bitir", callback_data="FINISH_MULTI"),
@@ -206,9 +413,10 @@ def cb_pick_mode(call):
             "Bitəndə 'Bitir' düyməsinə basın. Ləğv üçün 'Stop/Restart'.",
             reply_markup=kb
         )
-    d["barcodes"].clear()
-    d["index"] = 0
-    user_state[chat_id] = STATE_WAIT_PHOTO
+    with d.lock:
+        d.barcodes = []
+        d.index = 0
+        d.state = STATE_WAIT_PHOTO
 
 @bot.callback_query_handler(func=lambda c: c.data=="STOP_RESTART")
 def cb_stop_restart(call):
@@ -216,121 +424,404 @@ def cb_stop_restart(call):
     init_session(chat_id)
     bot.send_message(chat_id, "Proses ləğv edildi. Yeni gün üçün /start.")
 
+def pending_barcodes(d):
+    # data entry restarts at index 0: codes confirmed in an earlier round
+    # are dropped so they are not offered (and written) a second time
+    with d.lock:
+        d.barcodes = [bc for bc in d.barcodes if bc not in d.recorded]
+        return d.barcodes
+
 @bot.callback_query_handler(func=lambda c: c.data=="FINISH_MULTI")
 def cb_finish_multi(call):
     chat_id = call.message.chat.id
-    d = user_data[chat_id]
-    bcs = d["barcodes"]
+    d = get_session(chat_id)
+    bcs = pending_barcodes(d)
     if not bcs:
         bot.send_message(chat_id,"Heç barkod yoxdur. Yenidən foto göndərin.")
         return
-    d["index"] = 0
+    d.index = 0
     first_bc = bcs[0]
     bot.send_message(chat_id,
         f"{len(bcs)} barkod tapıldı.\n"
         f"1-ci barkod: <b>{first_bc}</b>\n"
         "Məhsul adını (tam və ya qismən) daxil edin."
     )
-    user_state[chat_id] = STATE_WAIT_ASSET
+    d.state = STATE_WAIT_ASSET
 
 ########################################
 # Multi-Barcode Detection
 ########################################
-def detect_multi_barcodes(np_img):
-    mean_val = np_img.mean()
-    if mean_val < 60:
-        np_img = cv2.convertScaleAbs(np_img, alpha=1.5, beta=30)
-
-    gray = cv2.cvtColor(np_img, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (3,3), 0)
-    _, thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-    inv = 255 - thresh
-
-    kernel_big = cv2.getStructuringElement(cv2.MORPH_RECT, (11,4))
-    morph1 = cv2.morphologyEx(inv, cv2.MORPH_CLOSE, kernel_big)
-
-    kernel_small = cv2.getStructuringElement(cv2.MORPH_RECT, (3,3))
-    morph2 = cv2.morphologyEx(morph1, cv2.MORPH_OPEN, kernel_small)
-
-    contours, _ = cv2.findContours(morph2, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    found_codes = set()
-    angles = range(0,360,10)
-
-    for c in contours:
-        x,y,w,h = cv2.boundingRect(c)
-        if w>20 and h>20:
-            region = np_img[y:y+h, x:x+w]
-            decodes = try_decode_region(region, angles)
-            for cd_ in decodes:
-                if is_our_barcode(cd_):
-                    found_codes.add(cd_)
-
-    entire_decodes = try_decode_region(np_img, angles)
-    for cd_ in entire_decodes:
-        if is_our_barcode(cd_):
-            found_codes.add(cd_)
+# OpenCV's QR detector localizes and decodes rotated QR codes in one
+# native pass. cv2.barcode is not used: it only reads EAN/UPC, which can
+# never carry an AZT code.
+# detectAndDecodeMulti keeps scratch state on the detector, so each
+# EXECUTOR thread gets its own instead of sharing one.
+_qr_local = threading.local()
+
+def qr_detector():
+    det = getattr(_qr_local, "det", None)
+    if det is None:
+        det = _qr_local.det = cv2.QRCodeDetector()
+    return det
+
+# whole-image decoding runs on a copy whose long edge is at most this many px
+DECODE_MAX_SIDE = 1600
+# long edge of the quick single-mode preview pass
+PREVIEW_MAX_SIDE = 640
+# region localization runs on a copy whose long edge is at most this many px
+DETECT_MAX_SIDE = 1024
+# full-res px added around each scaled-back box so rounding never clips bars
+ROI_MARGIN = 20
+# zbar reads codes within ~22 deg of either axis, so 0 and 45 cover any tilt
+WHOLE_IMAGE_ANGLES = (0, 45)
+# at most this many candidate regions (largest first) are decoded per photo
+MAX_REGIONS = 16
+
+KERNEL_CLOSE = cv2.getStructuringElement(cv2.MORPH_RECT, (11,4))
+KERNEL_OPEN = cv2.getStructuringElement(cv2.MORPH_RECT, (3,3))
+# our asset labels, e.g. 'AZT000123'
+AZT_RE = re.compile(r'AZT\d+')
+
+def downscale(gray, max_side):
+    scale = min(1.0, max_side / max(gray.shape[:2]))
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+def enhance_contrast(gray):
+    # CLAHE keeps local gradients where a global gain saturates highlights.
+    # CLAHE objects hold scratch buffers, so build one per call (threads).
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    return clahe.apply(gray)
+
+def decode_opencv_multi(gray):
+    try:
+        ok, infos = qr_detector().detectAndDecodeMulti(gray)[:2]
+    except cv2.error:
+        return []
+    return [s for s in infos if s] if ok else []
+
+def fast_attempts(gray):
+    # cheapest first; a generator so later variants are only built on a miss
+    yield gray
+    yield cv2.bitwise_not(gray)
+    yield enhance_contrast(gray)
+    yield cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)[1]
+    if max(gray.shape[:2]) < DETECT_MAX_SIDE:
+        yield cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+
+# below this Laplacian variance a photo is too blurred for the zbar sweep
+MIN_SHARPNESS = 50.0
+# below this gray-level std-dev a photo is too flat (blank wall, lens cap)
+MIN_CONTRAST = 20.0
+
+def check_image_quality(gray):
+    # int16 holds the default (ksize=1) Laplacian of uint8 input; meanStdDev
+    # reduces it natively instead of going through a float64 copy and
+    # ndarray.var(). MIN_SHARPNESS is calibrated for this kernel.
+    lap = cv2.Laplacian(gray, cv2.CV_16S)
+    _, stddev = cv2.meanStdDev(lap)
+    sharpness = float(stddev[0,0])**2
+    # global brightness/contrast are the same on every 4th pixel per axis,
+    # at 1/16 of the reads
+    mean, stddev = cv2.meanStdDev(np.ascontiguousarray(gray[::4, ::4]))
+    brightness, contrast = float(mean[0,0]), float(stddev[0,0])
+    return sharpness, brightness, contrast
+
+def detect_multi_barcodes(gray, single=False):
+    # gray is 8-bit luma straight from imdecode; quality check, crops,
+    # rotations and zbar all share it
+    sharpness, brightness, contrast = check_image_quality(gray)
+    boosted = brightness < 60
+    if boosted:
+        gray = enhance_contrast(gray)
+        # judge what the decoders will actually see; a dim label is low
+        # contrast by nature, so only the sharpness gate applies to it
+        sharpness, _, _ = check_image_quality(gray)
+
+    if single:
+        # single mode needs one code, and it usually fills the frame: a
+        # zbar pass on a 640 px preview reads that in a few ms
+        preview, _ = downscale(gray, PREVIEW_MAX_SIDE)
+        codes = [cd_ for cd_ in decode_zbar_multi(preview) if is_our_barcode(cd_)]
+        if codes:
+            return codes
+
+    if sharpness < MIN_SHARPNESS or (contrast < MIN_CONTRAST and not boosted):
+        # too blurred or too flat to read; skip every pass below
+        return []
+
+    # Telegram re-encodes photos to at most 2560 px on the long side; decode
+    # at <=1600 px and keep the full-size image as a fallback
+    work, _ = downscale(gray, DECODE_MAX_SIDE)
+
+    # clean photos decode on the whole image: this is the pass that reads
+    # our Code128/Code39 labels, so it runs before anything else
+    whole = try_decode_region(work, WHOLE_IMAGE_ANGLES)
+    if whole:
+        return whole
+
+    # QR labels that zbar missed: OpenCV's detector on cheap variants
+    for variant in fast_attempts(work):
+        fast = {cd_ for cd_ in decode_opencv_multi(variant) if is_our_barcode(cd_)}
+        if fast:
+            return list(fast)
+    if work is not gray:
+        # small labels may not survive the downscale
+        fast = {cd_ for cd_ in decode_opencv_multi(gray) if is_our_barcode(cd_)}
+        if fast:
+            return list(fast)
+
+    # find candidate regions on a downscaled copy, decode crops at full res
+    small, scale = downscale(gray, DETECT_MAX_SIDE)
+
+    # one scratch buffer for the whole blur -> threshold -> morph chain.
+    # A local (adaptive) threshold survives uneven shelf lighting where a
+    # global Otsu level loses labels; _INV yields the dark-bar mask directly.
+    buf = np.empty_like(small)
+    src = small
+    if scale == 1.0:
+        # a downscaled copy was already low-passed by INTER_AREA, so the
+        # denoising blur is only needed at native resolution
+        cv2.GaussianBlur(small, (3,3), 0, dst=buf)
+        src = buf
+    cv2.adaptiveThreshold(src, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                          cv2.THRESH_BINARY_INV, 31, 10, dst=buf)
+
+    cv2.morphologyEx(buf, cv2.MORPH_CLOSE, KERNEL_CLOSE, dst=buf)
+    cv2.morphologyEx(buf, cv2.MORPH_OPEN, KERNEL_OPEN, dst=buf)
+
+    # one labelling pass returns every blob's bounding box as an array, so
+    # there is no per-contour Python loop; label 0 is the background
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(buf, connectivity=8)
+    if n < 2:
+        return []
+
+    # filter and rank all boxes in one vectorized pass (full-res px), so
+    # only the largest few candidates ever reach zbar
+    rects = (stats[1:, :4] / scale).astype(np.int32)
+    keep = np.flatnonzero((rects[:,2] > 20) & (rects[:,3] > 20))
+    areas = rects[keep,2] * rects[keep,3]
+    keep = keep[np.argsort(-areas, kind="stable")][:MAX_REGIONS]
+
+    found_codes = {}  # dict as an insertion-ordered set
+    for i in keep:
+        x,y,w,h = rects[i]
+        y0, x0 = max(0, y-ROI_MARGIN), max(0, x-ROI_MARGIN)
+        region = gray[y0:y+h+ROI_MARGIN, x0:x+w+ROI_MARGIN]
+        # zbar scans rows and columns itself; a tilted label only needs
+        # one deskew by the blob's angle (sign depends on which edge
+        # minAreaRect reports, so try both)
+        sx, sy, sw, sh = stats[i+1, :4]
+        blob = cv2.findNonZero((labels[sy:sy+sh, sx:sx+sw]==i+1).view(np.uint8))
+        tilt = cv2.minAreaRect(blob)[2]
+        # minAreaRect reports (0, 90]; the smallest equivalent deskew is
+        # within +-45 deg, since zbar reads either axis
+        if tilt > 45:
+            tilt -= 90
+        angles = (0, tilt, -tilt) if tilt else (0,)
+        # a region holds one label, so stop at the first angle that reads it
+        found_codes.update(dict.fromkeys(try_decode_region(region, angles, stop_early=True)))
 
     return list(found_codes)
 
-def try_decode_region(np_img, angles):
-    results = set()
+def try_decode_region(gray, angles, stop_early=False):
+    results = {}  # dict as an insertion-ordered set
     for angle in angles:
-        rot = rotate_image(np_img, angle)
-        multi = decode_zbar_multi(rot)
-        for c_ in multi:
-            results.add(c_)
+        rot = rotate_image(gray, angle)
+        for c_ in decode_zbar_multi(rot):
+            if is_our_barcode(c_):
+                results[c_] = None
+        if stop_early and results:
+            break
     return list(results)
 
 def rotate_image(cv_img, angle):
+    if angle % 360 == 0:
+        return cv_img
     (h, w) = cv_img.shape[:2]
-    center = (w//2,h//2)
-    M = cv2.getRotationMatrix2D(center, angle, 1.0)
-    rotated = cv2.warpAffine(cv_img, M, (w,h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    M = cv2.getRotationMatrix2D((w/2, h/2), angle, 1.0)
+    # grow the canvas to the rotated bounding box so no corner of the
+    # label is clipped, and shift the result into its centre
+    cos, sin = abs(M[0,0]), abs(M[0,1])
+    nw, nh = int(h*sin + w*cos + 0.5), int(h*cos + w*sin + 0.5)
+    M[0,2] += (nw - w) / 2
+    M[1,2] += (nh - h) / 2
+    # bilinear is plenty for zbar's edge detection and is a 4-tap kernel
+    # where cubic is 16-tap; the new corners are filled white like a
+    # label's quiet zone rather than smeared edge pixels
+    rotated = cv2.warpAffine(cv_img, M, (nw,nh), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=255)
     return rotated
 
-def decode_zbar_multi(cv_img):
-    from PIL import Image
-    pil_img = Image.fromarray(cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB))
-    barcodes = decode(pil_img, symbols=[ZBarSymbol.CODE128, ZBarSymbol.CODE39,
-                                        ZBarSymbol.EAN13, ZBarSymbol.EAN8,
-                                        ZBarSymbol.QRCODE])
+# EAN is digits-only and can never carry an AZT code, so zbar skips it
+ZBAR_SYMBOLS = [ZBarSymbol.CODE128, ZBarSymbol.CODE39, ZBarSymbol.QRCODE]
+if zxingcpp:
+    ZXING_FORMATS = (zxingcpp.BarcodeFormat.Code128 | zxingcpp.BarcodeFormat.Code39
+                     | zxingcpp.BarcodeFormat.QRCode)
+
+def decode_zbar_multi(gray):
+    if zxingcpp:
+        # zxing-cpp reads the numpy array in place and is several times
+        # faster than libzbar on the same crop
+        return [r.text for r in zxingcpp.read_barcodes(gray, formats=ZXING_FORMATS)]
+    # pyzbar takes raw 8-bit pixels directly; no PIL wrapper needed
+    h, w = gray.shape[:2]
+    barcodes = decode((gray.tobytes(), w, h), symbols=ZBAR_SYMBOLS)
     out = []
     for b in barcodes:
         out.append(b.data.decode("utf-8"))
     return out
 
 def is_our_barcode(code):
-    # e.g. '^AZT\d+'
-    pat = r'^AZT\d+'
-    return bool(re.match(pat, code))
+    return AZT_RE.match(code) is not None
 
 ########################################
 # Photo Handler
 ########################################
+# Downloading and decoding run on a pool instead of the thread that
+# dispatches updates: OpenCV/zbar release the GIL, and the extra workers
+# let one user's Telegram download overlap another user's decode.
+EXECUTOR = ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) + 4)
+
+# Re-sent photos keep their file_unique_id, so an LRU of decoded codes
+# answers a retry without downloading or decoding the image again.
+SCAN_CACHE_SIZE = 256
+scan_cache = OrderedDict()  # (file_unique_id, single) -> codes
+scan_cache_lock = threading.Lock()
+
+def fetch_photo(file_id):
+    info = bot.get_file(file_id)
+    return bot.download_file(info.file_path)
+
+# single-mode photos arriving closer together than this are coalesced
+PHOTO_DEBOUNCE = 0.3  # seconds
+@dataclass(slots=True)
+class PhotoBurst:
+    newest: int                # message_id of the newest photo seen
+    held: object = None        # newest photo not scanned yet, if any
+    window_open: bool = True
+    first_done: bool = False   # the burst's first scan has been handled
+
+last_photo = {}  # chat_id -> PhotoBurst
+last_photo_lock = threading.Lock()
+
+def scan_photo(file_id, file_unique_id, single):
+    key = (file_unique_id, single)
+    with scan_cache_lock:
+        codes = scan_cache.get(key)
+        if codes is not None:
+            scan_cache.move_to_end(key)
+            return list(codes)
+    downloaded = fetch_photo(file_id)
+    np_img = np.frombuffer(downloaded, np.uint8)
+    # libjpeg can emit luma directly: no 3-channel buffer, no cvtColor
+    gray = cv2.imdecode(np_img, cv2.IMREAD_GRAYSCALE)
+    codes = detect_multi_barcodes(gray, single=single)
+    with scan_cache_lock:
+        scan_cache[key] = tuple(codes)
+        if len(scan_cache) > SCAN_CACHE_SIZE:
+            scan_cache.popitem(last=False)
+    return codes
+
 @bot.message_handler(content_types=['photo'])
 def handle_photo(m):
     chat_id = m.chat.id
-    st = user_state.get(chat_id, STATE_IDLE)
+    st = session_state(chat_id)
     if st!=STATE_WAIT_PHOTO:
         bot.send_message(chat_id, "Hazırda şəkil qəbul edilmir. /start ilə başlayın, sonra barkod göndərin.")
         return
 
-    file_id = m.photo[-1].file_id
-    info = bot.get_file(file_id)
-    downloaded = bot.download_file(info.file_path)
-    np_img = np.frombuffer(downloaded, np.uint8)
-    cv_img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-
-    found = detect_multi_barcodes(cv_img)
+    photo = m.photo[-1]
+    if get_session(chat_id).mode=="single":
+        # a lone photo is scanned at once and opens a short window; photos
+        # landing inside it are coalesced to the newest one. Handlers run
+        # on several threads, so "newest" is by message_id, not arrival.
+        with last_photo_lock:
+            burst = last_photo.get(chat_id)
+            if burst is None:
+                last_photo[chat_id] = PhotoBurst(m.message_id)
+            elif m.message_id > burst.newest:
+                burst.newest, burst.held = m.message_id, photo
+        if burst is None:
+            submit_scan(chat_id, photo, then=lambda: first_scan_done(chat_id))
+            t = threading.Timer(PHOTO_DEBOUNCE, close_photo_window, args=(chat_id,))
+            t.daemon = True
+            t.start()
+    else:
+        # multi mode: every photo may carry different codes
+        submit_scan(chat_id, photo)
+
+# A burst ends once its window has closed and its first scan has been
+# handled, whichever comes last; only then is the held photo considered.
+def close_photo_window(chat_id):
+    with last_photo_lock:
+        burst = last_photo[chat_id]
+        burst.window_open = False
+        if not burst.first_done:
+            return
+        del last_photo[chat_id]
+    scan_held_photo(chat_id, burst.held)
+
+def first_scan_done(chat_id):
+    with last_photo_lock:
+        burst = last_photo[chat_id]
+        burst.first_done = True
+        if burst.window_open:
+            return
+        del last_photo[chat_id]
+    scan_held_photo(chat_id, burst.held)
+
+def scan_held_photo(chat_id, photo):
+    # a code from the first photo already moved the session on; the held
+    # photo is only downloaded and decoded if that scan found nothing
+    if photo is not None and session_state(chat_id)==STATE_WAIT_PHOTO:
+        submit_scan(chat_id, photo)
+
+def submit_scan(chat_id, photo, then=None):
+    single = get_session(chat_id).mode=="single"
+    future = EXECUTOR.submit(scan_photo, photo.file_id, photo.file_unique_id, single)
+    def done(f):
+        try:
+            _on_decoded(chat_id, f)
+        finally:
+            # a failed reply must not leave a photo burst open forever
+            if then:
+                then()
+    future.add_done_callback(done)
+
+def _on_decoded(chat_id, future):
+    try:
+        found = future.result()
+    except Exception as e:
+        bot.send_message(chat_id, f"❌ Xəta: {e}")
+        return
     if not found:
         bot.send_message(chat_id,"Heç barkod tapılmadı. Daha aydın/böyük şəkil çəkin.")
         return
 
-    d = user_data[chat_id]
-    if d["mode"]=="single":
+    d = get_session(chat_id)
+    with d.lock:
+        if d.state!=STATE_WAIT_PHOTO:
+            # session was cancelled/finished while the photo was decoding
+            return
+        mode = d.mode
+        found = [cd_ for cd_ in found if cd_ not in d.recorded]
+        if found and mode=="single":
+            d.barcodes = [found[0]]
+            d.state = STATE_WAIT_ASSET
+        elif found:
+            # O(1) dedupe that keeps scan order for the data-entry steps
+            d.barcodes = list(dict.fromkeys(d.barcodes + found))
+
+    if not found:
+        bot.send_message(chat_id,
+            "Bu barkod(lar) artıq qeydə alınıb. Başqa foto göndərin.")
+        return
+
+    if mode=="single":
         # single mode: handle each photo as a single barkod
         bc = found[0]
-        d["barcodes"] = [bc]
         if len(found)>1:
             bot.send_message(chat_id,
                 f"{len(found)} barkod tapıldı, birincisi götürülür: <b>{bc}</b>")
@@ -338,15 +829,9 @@ def handle_photo(m):
             bot.send_message(chat_id,f"Barkod: <b>{bc}</b>")
         # ask for asset
         bot.send_message(chat_id,"Məhsul adını (tam/qismən) daxil edin.")
-        user_state[chat_id] = STATE_WAIT_ASSET
 
     else:
-        # multi mode: accumulate codes
-        existing = set(d["barcodes"])
-        for c_ in found:
-            existing.add(c_)
-        d["barcodes"] = list(existing)
-
+        # multi mode: codes were accumulated above
         kb = InlineKeyboardMarkup()
         kb.row(
             InlineKeyboardButton("Məlumat Daxil Et", callback_data="DATA_NOW"),
@@ -366,21 +851,21 @@ def handle_photo(m):
 @bot.callback_query_handler(func=lambda c: c.data in ["DATA_NOW","NEXT_PHOTO"])
 def cb_data_or_next(call):
     chat_id = call.message.chat.id
-    d = user_data[chat_id]
-    if c.data=="DATA_NOW":
+    d = get_session(chat_id)
+    if call.data=="DATA_NOW":
         # same as finishing scanning => start data entry
-        bcs = d["barcodes"]
+        bcs = pending_barcodes(d)
         if not bcs:
             bot.send_message(chat_id,"Heç barkod yoxdur. Yenidən şəkil göndərin.")
             return
-        d["index"] = 0
+        d.index = 0
         bc = bcs[0]
         bot.send_message(chat_id,
             f"{len(bcs)} barkod aşkarlandı.\n"
             f"1-ci barkod: <b>{bc}</b>\n"
             "Məhsul adını (tam/qismən) daxil edin."
         )
-        user_state[chat_id] = STATE_WAIT_ASSET
+        d.state = STATE_WAIT_ASSET
     else:
         # user continues scanning
         bot.send_message(chat_id,
@@ -390,19 +875,60 @@ def cb_data_or_next(call):
 ########################################
 # Fuzzy name
 ########################################
-def fuzzy_suggest(query, data, limit=3):
-    if not data:
+# asset names normalized once (lower-case, punctuation stripped) so each
+# query only has to normalize itself before scoring
+asset_keys = [utils.default_process(a) for a in asset_data]
+# WRatio below this is noise; rapidfuzz can also stop scoring a candidate
+# early once it cannot reach it
+FUZZY_MIN_SCORE = 60
+
+def fuzzy_suggest(query, limit=3):
+    if not asset_keys:
         return []
-    return process.extract(query, data, limit=limit)
-
-@bot.message_handler(func=lambda x: user_state.get(x.chat.id)==STATE_WAIT_ASSET, content_types=['text'])
+    q = utils.default_process(query)
+    # users mostly type a whole name or its start: plain exact, prefix and
+    # substring scans answer that without any edit-distance scoring.
+    # Within a tier the shortest names are the closest matches.
+    hits = {}
+    if q:
+        tiers = ((100, lambda key: key==q),
+                 (95, lambda key: key.startswith(q)),
+                 (90, lambda key: q in key))
+        for score, test in tiers:
+            if len(hits)==limit:
+                break
+            found = [i for i, key in enumerate(asset_keys) if i not in hits and test(key)]
+            found.sort(key=lambda i: len(asset_keys[i]))
+            for i in found[:limit-len(hits)]:
+                hits[i] = score
+    if len(hits)<limit:
+        # one uint8 score row computed natively across all cores; only the
+        # top k are partitioned out and sorted
+        scores = process.cdist([q], asset_keys, scorer=fuzz.WRatio, processor=None,
+                               score_cutoff=FUZZY_MIN_SCORE, dtype=np.uint8, workers=-1)[0]
+        k = min(limit+len(hits), len(scores))
+        top = np.argpartition(scores, len(scores)-k)[len(scores)-k:]
+        for i in top[np.argsort(scores[top], kind="stable")[::-1]]:
+            if len(hits)==limit or not scores[i]:
+                break
+            hits.setdefault(int(i), int(scores[i]))
+    return [(asset_data[i], sc) for i, sc in hits.items()]
+
+def asset_choices_text(suggestions):
+    if suggestions:
+        return "Uyğun adlar:"
+    # nothing scored high enough: the user can retype or keep their text
+    return "Uyğun ad tapılmadı. Yenidən yazın və ya 'Custom Name' seçin."
+
+@bot.message_handler(func=lambda x: session_state(x.chat.id)==STATE_WAIT_ASSET, content_types=['text'])
 def handle_asset_name(x):
     chat_id = x.chat.id
     q = x.text.strip()
-    suggestions = fuzzy_suggest(q, asset_data, limit=3)
-    if not suggestions:
+    if not asset_keys:
+        # no asset list loaded: nothing to pick from
         finalize_asset_info(chat_id, q)
         return
+    suggestions = fuzzy_suggest(q, limit=3)
 
     kb = InlineKeyboardMarkup()
     for (nm,sc) in suggestions:
@@ -412,17 +938,18 @@ def handle_asset_name(x):
     kb.add(InlineKeyboardButton(
         text="Custom Name", callback_data=f"ASSET_CUSTOM|{q}"
     ))
-    bot.send_message(chat_id,"Uyğun adlar:",reply_markup=kb)
-    user_state[chat_id] = STATE_WAIT_ASSET_PICK
+    bot.send_message(chat_id, asset_choices_text(suggestions), reply_markup=kb)
+    get_session(chat_id).state = STATE_WAIT_ASSET_PICK
 
-@bot.message_handler(func=lambda x: user_state.get(x.chat.id)==STATE_WAIT_ASSET_PICK, content_types=['text'])
+@bot.message_handler(func=lambda x: session_state(x.chat.id)==STATE_WAIT_ASSET_PICK, content_types=['text'])
 def handle_asset_retry(x):
     chat_id = x.chat.id
     q = x.text.strip()
-    suggestions = fuzzy_suggest(q, asset_data, limit=3)
-    if not suggestions:
+    if not asset_keys:
+        # no asset list loaded: nothing to pick from
         finalize_asset_info(chat_id, q)
         return
+    suggestions = fuzzy_suggest(q, limit=3)
 
     kb = InlineKeyboardMarkup()
     for (nm,sc) in suggestions:
@@ -432,7 +959,7 @@ def handle_asset_retry(x):
     kb.add(InlineKeyboardButton(
         text="Custom Name", callback_data=f"ASSET_CUSTOM|{q}"
     ))
-    bot.send_message(chat_id, "Uyğun adlar:", reply_markup=kb)
+    bot.send_message(chat_id, asset_choices_text(suggestions), reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("ASSET_PICK|"))
 def cb_asset_pick(call):
@@ -447,7 +974,7 @@ def cb_asset_custom(call):
     finalize_asset_info(chat_id, custom_)
 
 def finalize_asset_info(chat_id, name_):
-    user_data[chat_id]["asset_name"] = name_
+    get_session(chat_id).asset_name = name_
     ask_quantity(chat_id)
 
 ########################################
@@ -461,12 +988,12 @@ def ask_quantity(chat_id):
         InlineKeyboardButton("3", callback_data="QTY|3"),
         InlineKeyboardButton("Other", callback_data="QTY|OTHER")
     )
-    nm = user_data[chat_id]["asset_name"]
+    nm = get_session(chat_id).asset_name
     bot.send_message(chat_id,
         f"Məhsul adı: <b>{nm}</b>.\nMiqdarı seçin:",
         reply_markup=kb
     )
-    user_state[chat_id] = STATE_WAIT_QUANTITY
+    get_session(chat_id).state = STATE_WAIT_QUANTITY
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("QTY|"))
 def cb_qty_pick(call):
@@ -475,35 +1002,37 @@ def cb_qty_pick(call):
     if pick=="OTHER":
         bot.send_message(chat_id,"Rəqəm kimi miqdarı daxil edin.")
         return
-    user_data[chat_id]["qty"] = int(pick)
+    get_session(chat_id).qty = int(pick)
     show_entry_summary(chat_id)
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id)==STATE_WAIT_QUANTITY, content_types=['text'])
+@bot.message_handler(func=lambda m: session_state(m.chat.id)==STATE_WAIT_QUANTITY, content_types=['text'])
 def handle_qty_text(m):
     chat_id = m.chat.id
-    try:
-        val = int(m.text.strip())
-        user_data[chat_id]["qty"] = val
-        show_entry_summary(chat_id)
-    except:
+    pick = m.text.strip()
+    # isdecimal() is exactly what int() accepts here (isdigit() lets "²"
+    # through); the length cap keeps absurd quantities out of the sheet
+    if not pick.isdecimal() or len(pick)>9:
         bot.send_message(chat_id,"Düzgün rəqəm daxil edin.")
+        return
+    get_session(chat_id).qty = int(pick)
+    show_entry_summary(chat_id)
 
 ########################################
 # Show Summary => Edit/Delete/Confirm
 ########################################
 def show_entry_summary(chat_id):
-    d = user_data[chat_id]
-    idx = d["index"]
-    bc_list = d["barcodes"]
+    d = get_session(chat_id)
+    idx = d.index
+    bc_list = d.barcodes
     bc = bc_list[idx]
-    desc = d["asset_name"]
-    qty = d["qty"]
-    loc = d["location"]
-    inv = d["inventory_code"]
+    desc = d.asset_name
+    qty = d.qty
+    loc = d.location
+    inv = d.inventory_code
 
-    d["pending_barcode"] = bc
-    d["pending_asset"] = desc
-    d["pending_qty"] = qty
+    d.pending_barcode = bc
+    d.pending_asset = desc
+    d.pending_qty = qty
 
     text = (
         f"📋 Baxış:\n"
@@ -521,82 +1050,82 @@ def show_entry_summary(chat_id):
         InlineKeyboardButton("Confirm", callback_data="ENTRY_CONFIRM")
     )
     bot.send_message(chat_id, text, reply_markup=kb)
-    user_state[chat_id] = STATE_WAIT_CONFIRM
+    d.state = STATE_WAIT_CONFIRM
 
 @bot.callback_query_handler(func=lambda c: c.data in ["ENTRY_EDIT","ENTRY_DELETE","ENTRY_CONFIRM"])
 def cb_entry_decision(call):
     chat_id = call.message.chat.id
-    d = user_data[chat_id]
+    d = get_session(chat_id)
     choice = call.data
 
     if choice=="ENTRY_EDIT":
         bot.send_message(chat_id, "Məhsul adını yenidən daxil edin (tam və ya qismən).")
-        user_state[chat_id] = STATE_WAIT_ASSET
+        d.state = STATE_WAIT_ASSET
 
     elif choice=="ENTRY_DELETE":
         bot.send_message(chat_id,
             "Bu barkod məlumatı silindi. Başqa barkod üçün foto göndərə və ya /finish yazıb günü bitirə bilərsiniz.")
-        if d["mode"]=="multi":
-            d["index"]+=1
-            if d["index"]<len(d["barcodes"]):
-                next_bc = d["barcodes"][d["index"]]
+        if d.mode=="multi":
+            d.index+=1
+            if d.index<len(d.barcodes):
+                next_bc = d.barcodes[d.index]
                 bot.send_message(chat_id,
-                    f"{d['index']+1}-ci barkod: <b>{next_bc}</b>\n"
+                    f"{d.index+1}-ci barkod: <b>{next_bc}</b>\n"
                     "Məhsul adını daxil edin (tam/qismən)."
                 )
-                user_state[chat_id] = STATE_WAIT_ASSET
+                d.state = STATE_WAIT_ASSET
             else:
                 bot.send_message(chat_id,
                     "Bütün barkod məlumatı tamamlandı! Başqa foto göndərməyə davam\n"
                     "ya da /finish yaza bilərsiniz."
                 )
                 # We set back to WAIT_PHOTO so they can still send more if they want
-                user_state[chat_id] = STATE_WAIT_PHOTO
+                d.state = STATE_WAIT_PHOTO
         else:
             # single => set WAIT_PHOTO, so next photo can come without re-typing /start
             bot.send_message(chat_id,
                 "Tək barkod prosesi bitdi. Başqa foto göndərə ya da /finish edin.")
-            user_state[chat_id] = STATE_WAIT_PHOTO
+            d.state = STATE_WAIT_PHOTO
 
     else:
         # Confirm => append row
-        bc = d["pending_barcode"]
-        desc = d["pending_asset"]
-        qty = d["pending_qty"]
-        loc = d["location"]
-        inv = d["inventory_code"]
+        bc = d.pending_barcode
+        desc = d.pending_asset
+        qty = d.pending_qty
+        loc = d.location
+        inv = d.inventory_code
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        try:
-            main_sheet.append_row([now, loc, inv, bc, desc, qty])
-            bot.send_message(chat_id,
-                "✅ Məlumat Cədvələ Əlavə Olundu.\n"
-                "Başqa barkod üçün foto göndərə və ya /finish ilə günü bitirə bilərsiniz."
-            )
-        except Exception as e:
-            bot.send_message(chat_id, f"❌ Xəta: {e}")
+        queue_row(chat_id, [now, loc, inv, bc, desc, qty])
+        d.recorded.add(bc)
+        bot.send_message(chat_id,
+            "✅ Məlumat Qəbul Olundu, cədvələ yazılacaq.\n"
+            "Başqa barkod üçün foto göndərə və ya /finish ilə günü bitirə bilərsiniz."
+        )
 
-        if d["mode"]=="multi":
-            d["index"]+=1
-            if d["index"]<len(d["barcodes"]):
-                nb = d["barcodes"][d["index"]]
+        if d.mode=="multi":
+            d.index+=1
+            if d.index<len(d.barcodes):
+                nb = d.barcodes[d.index]
                 bot.send_message(chat_id,
-                    f"{d['index']+1}-ci barkod: <b>{nb}</b>\n"
+                    f"{d.index+1}-ci barkod: <b>{nb}</b>\n"
                     "Məhsul adını (tam/qismən) daxil edin."
                 )
-                user_state[chat_id] = STATE_WAIT_ASSET
+                d.state = STATE_WAIT_ASSET
             else:
                 bot.send_message(chat_id,
                     "Bütün barkodlar üçün məlumat tamamlandı!\n"
                     "İstəsəniz daha foto göndərmək olar,\n"
                     "ya da /finish ilə günü bitirin."
                 )
-                user_state[chat_id] = STATE_WAIT_PHOTO
+                d.state = STATE_WAIT_PHOTO
+                # end of a multi scan is a natural batch: write it off-thread
+                EXECUTOR.submit(flush_rows_logged, chat_id)
         else:
             # single
             bot.send_message(chat_id,
                 "Tək barkod prosesini tamamladınız. Başqa foto göndərə ya da /finish.")
             # crucial fix: we remain in WAIT_PHOTO
-            user_state[chat_id] = STATE_WAIT_PHOTO
+            d.state = STATE_WAIT_PHOTO
 
 ########################################
 # Flask
@@ -614,6 +1143,11 @@ def telegram_webhook():
         return "ok",200
     abort(403)
 
+# Register the webhook on import so gunicorn workers receive pushed updates
+setup_webhook()
+start_flush_timer()
+# gunicorn workers leave through sys.exit on SIGTERM, so atexit runs there
+atexit.register(flush_on_exit)
+
 if __name__=="__main__":
-    setup_webhook()
-    pass
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
@@ -0,0 +1,43 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ASSETS = ["Asset Name", "Monitor", "Monitor Stand", "Printer"]
+
+
+@pytest.fixture(scope="session")
+def botmod(tmp_path_factory):
+    """Import bot.py with Google Sheets and the Telegram webhook faked out."""
+    for dep in ("cv2", "telebot", "gspread", "pyzbar.pyzbar", "rapidfuzz"):
+        pytest.importorskip(dep)
+
+    asset_sheet = mock.MagicMock()
+    asset_sheet.col_values.return_value = list(ASSETS)
+    gc = mock.MagicMock()
+    gc.open_by_key.return_value.worksheet.return_value = asset_sheet
+    env = {
+        "TELEGRAM_BOT_TOKEN": "123456:TEST",
+        "SPREADSHEET_ID": "test-sheet",
+        "SERVICE_ACCOUNT_JSON": "{}",
+        "ASSET_CACHE_PATH": str(tmp_path_factory.mktemp("cache") / "assets.json"),
+    }
+    with mock.patch.dict(os.environ, env), \
+         mock.patch("google.oauth2.service_account.Credentials.from_service_account_info"), \
+         mock.patch("gspread.authorize", return_value=gc), \
+         mock.patch("telebot.TeleBot.remove_webhook"), \
+         mock.patch("telebot.TeleBot.set_webhook"):
+        import bot
+    return bot
+
+
+@pytest.fixture
+def sent(botmod, monkeypatch):
+    """Texts the bot would have sent, in order."""
+    out = []
+    monkeypatch.setattr(botmod.bot, "send_message",
+                        lambda chat_id, text, **kw: out.append(text))
+    return out
@@ -0,0 +1,26 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+
+def dim_qr(text):
+    qr = cv2.QRCodeEncoder.create().encode(text)
+    qr = cv2.resize(qr, None, fx=8, fy=8, interpolation=cv2.INTER_NEAREST)
+    qr = cv2.copyMakeBorder(qr, 40, 40, 40, 40, cv2.BORDER_CONSTANT, value=255)
+    # squeeze black/white into 20..55: a dark, flat shot of a real label
+    return (20 + qr.astype(np.float32) * (35 / 255)).astype(np.uint8)
+
+
+def test_dim_label_is_rescued_by_clahe(botmod):
+    img = dim_qr("AZT000123")
+    _, brightness, contrast = botmod.check_image_quality(img)
+    assert brightness < 60 and contrast < botmod.MIN_CONTRAST
+
+    assert botmod.detect_multi_barcodes(img) == ["AZT000123"]
+
+
+def test_flat_bright_photo_is_rejected(botmod):
+    img = np.full((480, 640), 200, np.uint8)
+
+    assert botmod.detect_multi_barcodes(img) == []
@@ -0,0 +1,61 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+
+def chat(chat_id):
+    return SimpleNamespace(id=chat_id)
+
+
+def callback(chat_id, data):
+    return SimpleNamespace(data=data, message=SimpleNamespace(chat=chat(chat_id)))
+
+
+def decoded(codes):
+    f = Future()
+    f.set_result(codes)
+    return f
+
+
+def confirm_all(botmod, chat_id):
+    # walk every offered barcode through name -> qty -> Confirm
+    d = botmod.get_session(chat_id)
+    while d.state==botmod.STATE_WAIT_ASSET:
+        botmod.finalize_asset_info(chat_id, "Monitor")
+        botmod.cb_qty_pick(callback(chat_id, "QTY|1"))
+        botmod.cb_entry_decision(callback(chat_id, "ENTRY_CONFIRM"))
+
+
+def test_multi_mode_second_photo_skips_confirmed_codes(botmod, sent, monkeypatch):
+    rows = []
+    monkeypatch.setattr(botmod, "queue_row", lambda chat_id, row: rows.append(row))
+    monkeypatch.setattr(botmod, "flush_rows_logged", lambda chat_id: None)
+    chat_id = 1001
+    botmod.init_session(chat_id)
+    d = botmod.get_session(chat_id)
+    d.mode, d.state = "multi", botmod.STATE_WAIT_PHOTO
+
+    botmod._on_decoded(chat_id, decoded(["AZT1", "AZT2"]))
+    botmod.cb_data_or_next(callback(chat_id, "DATA_NOW"))
+    confirm_all(botmod, chat_id)
+    assert d.state==botmod.STATE_WAIT_PHOTO
+
+    # second photo shows one code again and one new code
+    botmod._on_decoded(chat_id, decoded(["AZT2", "AZT3"]))
+    botmod.cb_finish_multi(callback(chat_id, "FINISH_MULTI"))
+    assert d.barcodes==["AZT3"]
+    confirm_all(botmod, chat_id)
+
+    assert [r[3] for r in rows]==["AZT1", "AZT2", "AZT3"]
+
+
+def test_rescanned_code_alone_is_reported(botmod, sent):
+    chat_id = 1002
+    botmod.init_session(chat_id)
+    d = botmod.get_session(chat_id)
+    d.mode, d.state = "single", botmod.STATE_WAIT_PHOTO
+    d.recorded.add("AZT9")
+
+    botmod._on_decoded(chat_id, decoded(["AZT9"]))
+
+    assert d.state==botmod.STATE_WAIT_PHOTO
+    assert "artıq qeydə alınıb" in sent[-1]